@@ -1,21 +1,32 @@
 import os
+import re
 import json
+import time
+import shutil
+import threading
 import base64
+import hashlib
 import random
+import secrets
 import string
 import smtplib
+import zipfile
 from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from urllib.parse import urlparse, urlencode
 from urllib.request import Request, urlopen
 from urllib.error import URLError, HTTPError
 
+import click
 from flask import (
     Flask, render_template, request, redirect, url_for,
-    session, send_from_directory, make_response, flash
+    session, send_from_directory, make_response, flash, jsonify,
+    Response, stream_with_context
 )
 from werkzeug.utils import secure_filename
+from jinja2 import FileSystemBytecodeCache
 
 try:
     from PIL import Image, ImageOps
@@ -23,6 +34,11 @@ except Exception:
     Image = None
     ImageOps = None
 
+try:
+    import qrcode
+except Exception:
+    qrcode = None
+
 app = Flask(__name__)
 app.jinja_env.add_extension('jinja2.ext.do')
 app.secret_key = "pay4you_final_fix_v8"
@@ -34,8 +50,20 @@ else:
 
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
 DB_FILE = os.path.join(BASE_DIR, 'clients.json')
+UPLOAD_SESSIONS_DIR = os.path.join(BASE_DIR, 'upload_sessions')
+STATIC_EXPORT_DIR = os.getenv("STATIC_EXPORT_DIR", os.path.join(BASE_DIR, 'static_export'))
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(UPLOAD_SESSIONS_DIR, exist_ok=True)
+
+# Bytecode dei template condiviso tra i worker (scrittura atomica lato Jinja).
+JINJA_CACHE_DIR = os.getenv("JINJA_CACHE_DIR", os.path.join(BASE_DIR, 'jinja_cache'))
+HOT_TEMPLATES = ('edit_card.html', 'master_dashboard.html', 'dashboard.html', 'card.html', 'menu_card.html')
+try:
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+except OSError as e:
+    print(f"Cache template disattivata: {e}")
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 160 * 1024 * 1024
 
@@ -47,10 +75,38 @@ MAX_IMAGE_MB = 8
 MAX_VIDEO_MB = 40
 MAX_PDF_MB = 16
 
+AVATAR_MASTER_PX = 2048
+
+REENCODE_MAX_PX = 2048
+REENCODE_QUALITY = 85
+REENCODE_MIN_SAVING = 0.1
+REENCODE_BATCH = 50
+
 ALLOWED_IMAGE_EXT = {'jpg', 'jpeg', 'png', 'webp'}
 ALLOWED_VIDEO_EXT = {'mp4', 'mov', 'webm', 'm4v'}
 ALLOWED_PDF_EXT = {'pdf'}
 
+UPLOAD_CHUNK_MB = 8
+UPLOAD_CHECKSUM_ALGOS = ('sha256', 'sha1', 'md5')
+UPLOAD_SESSION_TTL = 24 * 3600
+
+CHUNKED_UPLOAD_KINDS = {
+    'vid': {'field': 'gallery_vid', 'tag': 'gvid', 'exts': ALLOWED_VIDEO_EXT, 'max_mb': MAX_VIDEO_MB, 'max_items': MAX_GALLERY_VID},
+    'pdf': {'field': 'gallery_pdf', 'tag': 'gpdf', 'exts': ALLOWED_PDF_EXT, 'max_mb': MAX_PDF_MB, 'max_items': MAX_GALLERY_PDF},
+}
+
+CARD_SW_REVALIDATE_SECONDS = 6 * 3600
+CARD_SW_MAX_AGE = 300
+CARD_SW_CDN_HOSTS = ('cdnjs.cloudflare.com',)
+
+STORAGE_QUOTA_MB = int(os.getenv("STORAGE_QUOTA_MB", "0").strip() or "0")
+
+GALLERY_PAGE_SIZE = {'img': 10, 'vid': 4, 'pdf': 6}
+GALLERY_FIELDS = {'img': 'gallery_img', 'vid': 'gallery_vid', 'pdf': 'gallery_pdf'}
+
+SLUG_MISS_TTL = 30
+SLUG_MISS_MAX = 5000
+
 CARD_BASE_URL = os.getenv("CARD_BASE_URL", "https://pay4you-cards-fire.onrender.com").rstrip("/")
 
 SMTP_HOST = os.getenv("SMTP_HOST", "").strip()
@@ -72,7 +128,7 @@ def load_db():
         return []
     try:
         with open(DB_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+            return [Client(c) for c in json.load(f)]
     except Exception:
         return []
 
@@ -80,42 +136,187 @@ def load_db():
 def save_db(data):
     try:
         with open(DB_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
+            json.dump([record_json(c) for c in data], f, ensure_ascii=False, separators=(',', ':'))
     except Exception as e:
         print(f"Errore DB: {e}")
+        return False
+    set_slug_index((c.get('slug') for c in data), db_mtime())
+    return True
+
+
+# Indice degli slug in memoria: i path sconosciuti (bot, scanner) vengono
+# respinti senza leggere clients.json. Lo scrivente lo aggiorna in save_db,
+# gli altri worker lo ricaricano quando cambia l'mtime del file.
+_slug_index = {'slugs': frozenset(), 'mtime': None}
+_slug_misses = {}
+_slug_lock = threading.Lock()
+
+
+def db_mtime():
+    try:
+        return os.stat(DB_FILE).st_mtime_ns
+    except OSError:
+        return None
+
+
+def set_slug_index(slugs, mtime):
+    with _slug_lock:
+        _slug_index['slugs'] = frozenset(s for s in slugs if s)
+        _slug_index['mtime'] = mtime
+        _slug_misses.clear()
 
 
-def save_file(file, prefix):
+def reload_slug_index():
+    mtime = db_mtime()
+    slugs = []
+    if mtime is not None:
+        try:
+            with open(DB_FILE, 'r', encoding='utf-8') as f:
+                slugs = [c.get('slug') for c in json.load(f)]
+        except Exception:
+            # Lettura a metà di una scrittura: si tiene l'indice precedente e si riprova alla prossima richiesta.
+            return False
+    set_slug_index(slugs, mtime)
+    return True
+
+
+def slug_exists(slug: str) -> bool:
+    if slug in _slug_index['slugs']:
+        return True
+    now = time.time()
+    mtime = db_mtime()
+    # Un miss vale solo per la versione del file in cui è stato registrato (slug creati da altri worker).
+    expires, miss_mtime = _slug_misses.get(slug, (0, None))
+    if expires > now and miss_mtime == mtime:
+        return False
+    if mtime != _slug_index['mtime']:
+        if not reload_slug_index():
+            return True
+        if slug in _slug_index['slugs']:
+            return True
+    with _slug_lock:
+        if len(_slug_misses) >= SLUG_MISS_MAX:
+            _slug_misses.clear()
+        _slug_misses[slug] = (now + SLUG_MISS_TTL, _slug_index['mtime'])
+    return False
+
+
+def upload_shard(filename: str) -> str:
+    m = re.match(r'^u(\d+)_', filename)
+    if m:
+        return f"u{m.group(1)}"
+    return hashlib.md5(filename.encode('utf-8')).hexdigest()[:2]
+
+
+def upload_target(filename: str):
+    rel = f"{upload_shard(filename)}/{filename}"
+    fp = os.path.join(app.config['UPLOAD_FOLDER'], rel)
+    os.makedirs(os.path.dirname(fp), exist_ok=True)
+    return fp, f"/uploads/{rel}"
+
+
+def storage_counters(user, pid: str = None) -> dict:
+    st = user.get('storage')
+    if not isinstance(st, dict):
+        st = user['storage'] = {'bytes': 0, 'files': 0, 'profiles': {}}
+    if pid is None:
+        return st
+    profiles = st.setdefault('profiles', {})
+    return profiles.setdefault(pid, {'bytes': 0, 'files': 0})
+
+
+def storage_account(user, pid: str, delta_bytes: int, delta_files: int):
+    if user is None or not pid:
+        return
+    for counters in (storage_counters(user), storage_counters(user, pid)):
+        counters['bytes'] = max(0, int(counters.get('bytes', 0)) + int(delta_bytes))
+        counters['files'] = max(0, int(counters.get('files', 0)) + int(delta_files))
+
+
+def storage_quota_bytes(user) -> int:
+    quota_mb = user.get('quota_mb')
+    if quota_mb is None or quota_mb == '':
+        quota_mb = STORAGE_QUOTA_MB
+    return max(0, to_int(quota_mb, 0)) * 1024 * 1024
+
+
+def storage_quota_ok(user, incoming_bytes: int) -> bool:
+    quota = storage_quota_bytes(user)
+    return not quota or storage_counters(user).get('bytes', 0) + incoming_bytes <= quota
+
+
+def stored_size(fp: str) -> int:
+    try:
+        return os.path.getsize(fp)
+    except OSError:
+        return -1
+
+
+def save_file(file, prefix, user=None, pid=None):
     if file and file.filename:
         filename = secure_filename(f"{prefix}_{file.filename}")
-        file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        return f"/uploads/{filename}"
+        fp, url = upload_target(filename)
+        old_size = stored_size(fp)
+        file.save(fp)
+        storage_account(user, pid, stored_size(fp) - max(old_size, 0), 0 if old_size >= 0 else 1)
+        return url
     return None
 
 
-def replace_uploaded_file_from_bytes(content: bytes, original_filename: str, prefix: str, fallback_ext: str = "jpg"):
+def replace_uploaded_file_from_bytes(content: bytes, original_filename: str, prefix: str, fallback_ext: str = "jpg", user=None, pid=None):
     ext = get_file_ext(original_filename)
     if ext not in (ALLOWED_IMAGE_EXT | ALLOWED_VIDEO_EXT | ALLOWED_PDF_EXT):
         ext = fallback_ext
     safe_prefix = secure_filename(prefix)
     filename = secure_filename(f"{safe_prefix}.{ext}")
-    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    path, url = upload_target(filename)
+    old_size = stored_size(path)
     with open(path, 'wb') as f:
         f.write(content)
-    return f"/uploads/{filename}"
+    storage_account(user, pid, len(content) - max(old_size, 0), 0 if old_size >= 0 else 1)
+    return url
+
+
+def resolve_upload_rel(rel: str):
+    # Durante la migrazione un URL piatto può puntare a un file già spostato nello shard (e viceversa).
+    parts = rel.split('/')
+    if not parts or len(parts) > 2 or any(not x or x != secure_filename(x) for x in parts):
+        return None
+    filename = parts[-1]
+    candidates = [rel, f"{upload_shard(filename)}/{filename}", filename]
+    for cand in dict.fromkeys(candidates):
+        if os.path.isfile(os.path.join(app.config['UPLOAD_FOLDER'], cand)):
+            return cand
+    return None
+
+
+def uploaded_url_path(url_path: str):
+    if not url_path:
+        return None
+    parsed = urlparse(str(url_path)).path
+    if not parsed.startswith('/uploads/'):
+        return None
+    rel = resolve_upload_rel(parsed.split('/uploads/', 1)[1])
+    if not rel:
+        return None
+    return os.path.join(app.config['UPLOAD_FOLDER'], rel)
 
 
-def delete_uploaded_url(url_path: str):
+def release_uploaded_url(url_path: str, user=None, pid=None) -> str:
+    # Scala subito i contatori: il file si cancella solo dopo che il record è stato salvato.
+    fp = uploaded_url_path(url_path)
+    if fp:
+        storage_account(user, pid, -max(stored_size(fp), 0), -1)
+    return url_path
+
+
+def delete_uploaded_url(url_path: str, user=None, pid=None):
     try:
-        if not url_path:
-            return
-        parsed = urlparse(str(url_path)).path
-        if not parsed.startswith('/uploads/'):
-            return
-        filename = parsed.split('/uploads/', 1)[1]
-        fp = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        if os.path.isfile(fp):
+        fp = uploaded_url_path(url_path)
+        if fp:
+            size = stored_size(fp)
             os.remove(fp)
+            storage_account(user, pid, -max(size, 0), -1)
     except Exception:
         pass
 
@@ -134,6 +335,196 @@ def to_float(v, d=1.0):
         return d
 
 
+class Record:
+    """Record compatto a slot: i default restano sulla classe e non finiscono nel JSON."""
+    __slots__ = ('_extra',)
+    _defaults = {}
+    _factories = {}
+    _types = {}
+    _fields = frozenset()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._fields = frozenset(cls._defaults) | frozenset(cls._factories)
+
+    def __init__(self, data=None):
+        if isinstance(data, Record):
+            data = data.to_dict()
+        for k, v in (data or {}).items():
+            self[k] = v
+
+    def __getattr__(self, name):
+        cls = type(self)
+        factory = cls._factories.get(name)
+        if factory is not None:
+            value = factory()
+            object.__setattr__(self, name, value)
+            return value
+        if name in cls._defaults:
+            return cls._defaults[name]
+        raise AttributeError(name)
+
+    def _extras(self, create=False):
+        try:
+            return object.__getattribute__(self, '_extra')
+        except AttributeError:
+            if not create:
+                return None
+            extra = {}
+            object.__setattr__(self, '_extra', extra)
+            return extra
+
+    def _coerce(self, key, value):
+        spec = type(self)._types.get(key)
+        if spec is None:
+            return value
+        if isinstance(spec, type) and issubclass(spec, Record):
+            return value if isinstance(value, spec) else spec(value if isinstance(value, dict) else None)
+        if isinstance(spec, tuple):
+            if not isinstance(value, list):
+                return []
+            item_cls = spec[1]
+            if item_cls is None:
+                return value
+            return [item_cls(x) if isinstance(x, dict) else x for x in value]
+        return spec(value, type(self)._defaults.get(key))
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            return getattr(self, key)
+        extra = self._extras()
+        if extra is not None and key in extra:
+            return extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self._fields:
+            object.__setattr__(self, key, self._coerce(key, value))
+        else:
+            self._extras(create=True)[key] = value
+
+    def __contains__(self, key):
+        if key in self._fields:
+            return True
+        extra = self._extras()
+        return extra is not None and key in extra
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def to_dict(self) -> dict:
+        cls = type(self)
+        out = {}
+        for name in cls.__slots__:
+            try:
+                value = object.__getattribute__(self, name)
+            except AttributeError:
+                continue
+            if name in cls._defaults and value == cls._defaults[name]:
+                continue
+            value = record_json(value)
+            if name in cls._factories and not value:
+                continue
+            out[name] = value
+        out.update(self._extras() or {})
+        return out
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+def record_json(value):
+    if isinstance(value, Record):
+        return value.to_dict()
+    if isinstance(value, list):
+        return [record_json(x) for x in value]
+    if isinstance(value, dict):
+        return {k: record_json(v) for k, v in value.items()}
+    return value
+
+
+def record_json_default(value):
+    if isinstance(value, Record):
+        return value.to_dict()
+    return str(value)
+
+
+class Social(Record):
+    _defaults = {'label': '', 'url': ''}
+    __slots__ = tuple(_defaults)
+
+
+class GalleryItem(Record):
+    _defaults = {'path': '', 'name': ''}
+    __slots__ = tuple(_defaults)
+
+
+class TransBlock(Record):
+    _defaults = {'role': '', 'bio': ''}
+    __slots__ = tuple(_defaults)
+
+
+class Translations(Record):
+    _factories = {'en': TransBlock, 'fr': TransBlock, 'es': TransBlock, 'de': TransBlock}
+    _types = dict(_factories)
+    __slots__ = tuple(_factories)
+
+
+class AdminContact(Record):
+    _defaults = {'email': '', 'whatsapp': ''}
+    __slots__ = tuple(_defaults)
+
+
+class Profile(Record):
+    _defaults = {
+        'active': False,
+        'name': '', 'role': '', 'company': '', 'bio': '',
+        'foto': '', 'foto_master': '', 'logo': '', 'personal_foto': '',
+        'office_phone': '', 'address': '',
+        'piva': '', 'cod_sdi': '', 'pec': '',
+        'fx_rotate_logo': 'off', 'fx_rotate_agent': 'off',
+        'fx_interaction': 'tap', 'fx_back_content': 'logo',
+        'pos_x': 0, 'pos_y': 0, 'zoom': 1.0,
+    }
+    _factories = {
+        'mobiles': list, 'emails': list, 'websites': list, 'socials': list,
+        'gallery_img': list, 'gallery_vid': list, 'gallery_pdf': list,
+        'trans': Translations,
+    }
+    _types = {
+        'mobiles': ('list', None), 'emails': ('list', None), 'websites': ('list', None),
+        'socials': ('list', Social),
+        'gallery_img': ('list', None), 'gallery_vid': ('list', None),
+        'gallery_pdf': ('list', GalleryItem),
+        'trans': Translations,
+        'pos_x': to_int, 'pos_y': to_int, 'zoom': to_float,
+    }
+    __slots__ = tuple(_defaults) + tuple(_factories)
+
+
+class Client(Record):
+    _defaults = {
+        'id': None, 'slug': '', 'username': '', 'password': '',
+        'must_change_password': True, 'reset_token': '', 'reset_expires': 0,
+        'nome': '', 'default_profile': 'p1', 'quota_mb': None,
+    }
+    _factories = {
+        'admin_contact': AdminContact,
+        'p1': Profile, 'p2': Profile, 'p3': Profile,
+        'storage': dict,
+    }
+    _types = {'admin_contact': AdminContact, 'p1': Profile, 'p2': Profile, 'p3': Profile}
+    __slots__ = tuple(_defaults) + tuple(_factories)
+
+
 def normalize_phone(phone: str) -> str:
     phone = str(phone or "").strip()
     if not phone:
@@ -201,98 +592,95 @@ def validate_upload(file_storage, allowed_exts: set, max_mb: int):
     return True, ""
 
 
+def upload_session_file(upload_id: str, ext: str) -> str:
+    return os.path.join(UPLOAD_SESSIONS_DIR, f"{upload_id}.{ext}")
+
+
+def load_upload_session(upload_id: str):
+    upload_id = str(upload_id or "")
+    if len(upload_id) != 32 or any(ch not in string.hexdigits for ch in upload_id):
+        return None
+    try:
+        with open(upload_session_file(upload_id, 'json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+    except Exception:
+        return None
+    if time.time() - meta.get('created', 0) > UPLOAD_SESSION_TTL:
+        drop_upload_session(upload_id)
+        return None
+    return meta
+
+
+def save_upload_session(meta: dict):
+    path = upload_session_file(meta['id'], 'json')
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(tmp, path)
+
+
+def drop_upload_session(upload_id: str):
+    for ext in ('json', 'part'):
+        try:
+            os.remove(upload_session_file(upload_id, ext))
+        except OSError:
+            pass
+
+
+def purge_expired_upload_sessions():
+    now = time.time()
+    try:
+        names = os.listdir(UPLOAD_SESSIONS_DIR)
+    except OSError:
+        return
+    for name in names:
+        fp = os.path.join(UPLOAD_SESSIONS_DIR, name)
+        try:
+            if now - os.path.getmtime(fp) > UPLOAD_SESSION_TTL:
+                os.remove(fp)
+        except OSError:
+            pass
+
+
+def parse_upload_checksum(header: str):
+    # Formato tus: "Upload-Checksum: <algoritmo> <digest base64>". Si calcola solo l'algoritmo richiesto.
+    if not header:
+        return None, None
+    algo, _, value = header.strip().partition(' ')
+    if algo.lower() not in UPLOAD_CHECKSUM_ALGOS:
+        raise ValueError(algo)
+    return hashlib.new(algo.lower()), base64.b64decode(value.strip(), validate=True)
+
+
 def repair_user(user):
+    # I default vivono nelle classi del modello: qui si normalizzano solo i valori salvati con tipo errato.
     dirty = False
-    if 'default_profile' not in user:
-        user['default_profile'] = 'p1'
-        dirty = True
-    if 'nome' not in user:
-        user['nome'] = ''
-        dirty = True
-    if 'must_change_password' not in user:
-        user['must_change_password'] = True
-        dirty = True
-    if 'reset_token' not in user:
-        user['reset_token'] = ''
-        dirty = True
-    if 'reset_expires' not in user:
-        user['reset_expires'] = 0
-        dirty = True
-    if 'admin_contact' not in user or not isinstance(user['admin_contact'], dict):
-        user['admin_contact'] = {'email': '', 'whatsapp': ''}
-        dirty = True
-    else:
-        if 'email' not in user['admin_contact']:
-            user['admin_contact']['email'] = ''
-            dirty = True
-        if 'whatsapp' not in user['admin_contact']:
-            user['admin_contact']['whatsapp'] = ''
-            dirty = True
-    for pid in ['p1', 'p2', 'p3']:
-        if pid not in user:
-            user[pid] = {'active': False}
-            dirty = True
+    for pid in ('p1', 'p2', 'p3'):
         p = user[pid]
-        defaults = {
-            'active': False,
-            'name': '', 'role': '', 'company': '', 'bio': '',
-            'foto': '', 'logo': '', 'personal_foto': '',
-            'office_phone': '', 'address': '',
-            'mobiles': [], 'emails': [], 'websites': [], 'socials': [],
-            'gallery_img': [], 'gallery_vid': [], 'gallery_pdf': [],
-            'piva': '', 'cod_sdi': '', 'pec': '',
-            'fx_rotate_logo': 'off', 'fx_rotate_agent': 'off',
-            'fx_interaction': 'tap', 'fx_back_content': 'logo',
-            'pos_x': 0, 'pos_y': 0, 'zoom': 1.0,
-            'trans': {'en': {}, 'fr': {}, 'es': {}, 'de': {}}
-        }
-        for k, v in defaults.items():
-            if k not in p:
-                p[k] = v
+        for key, conv, d in (('pos_x', to_int, 0), ('pos_y', to_int, 0), ('zoom', to_float, 1.0)):
+            value = p[key]
+            fixed = conv(value, d)
+            if fixed != value or type(fixed) is not type(value):
+                p[key] = fixed
                 dirty = True
-        if not isinstance(p.get('emails'), list):
-            p['emails'] = []
-            dirty = True
-        if not isinstance(p.get('websites'), list):
-            p['websites'] = []
-            dirty = True
-        if p.get('socials') is None:
-            p['socials'] = []
-            dirty = True
-        if p.get('trans') is None or not isinstance(p.get('trans'), dict):
-            p['trans'] = defaults['trans']
-            dirty = True
-        if p.get('gallery_img') is None:
-            p['gallery_img'] = []
-            dirty = True
-        if p.get('gallery_vid') is None:
-            p['gallery_vid'] = []
-            dirty = True
-        if p.get('gallery_pdf') is None:
-            p['gallery_pdf'] = []
-            dirty = True
-        p['pos_x'] = to_int(p.get('pos_x', 0), 0)
-        p['pos_y'] = to_int(p.get('pos_y', 0), 0)
-        p['zoom'] = to_float(p.get('zoom', 1.0), 1.0)
     return dirty
 
 
+@app.template_filter('filesize')
+def filesize_filter(n):
+    n = float(n or 0)
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024 or unit == 'GB':
+            return f"{n:.0f} {unit}" if unit == 'B' else f"{n:.1f} {unit}"
+        n /= 1024
+
+
 def make_random_password(length=12):
     chars = string.ascii_letters + string.digits + "!@#$%^&*"
     return ''.join(random.choice(chars) for _ in range(length))
 
 
-def save_cropped_agent_photo(file_storage, prefix: str, pos_x: int, pos_y: int, zoom: float):
-    if not file_storage or not file_storage.filename:
-        return None
-    ok, err = validate_upload(file_storage, ALLOWED_IMAGE_EXT, MAX_IMAGE_MB)
-    if not ok:
-        raise ValueError(err)
-    if Image is None:
-        return save_file(file_storage, f"{prefix}_foto")
-    file_storage.stream.seek(0)
-    img = Image.open(file_storage.stream)
-    img = ImageOps.exif_transpose(img).convert('RGB')
+def crop_agent_image(img, pos_x: int, pos_y: int, zoom: float):
     w, h = img.size
     viewport = 160.0
     base_scale = max(viewport / w, viewport / h)
@@ -314,8 +702,78 @@ def save_cropped_agent_photo(file_storage, prefix: str, pos_x: int, pos_y: int,
     cropped = ImageOps.fit(cropped, (800, 800), method=Image.LANCZOS, centering=(0.5, 0.5))
     bio = BytesIO()
     cropped.save(bio, format='JPEG', quality=92, optimize=True)
-    bio.seek(0)
-    return replace_uploaded_file_from_bytes(bio.read(), file_storage.filename, f"{prefix}_foto_crop", fallback_ext="jpg")
+    return bio.getvalue()
+
+
+def agent_crop_prefix(master_url: str, prefix: str, pos_x: int, pos_y: int, zoom: float) -> str:
+    # Il nome del ritaglio dipende da master e parametri: ogni nuovo ritaglio ha un URL nuovo.
+    key = f"{master_url}|{to_int(pos_x, 0)}|{to_int(pos_y, 0)}|{max(0.5, min(3.0, to_float(zoom, 1.0))):.2f}"
+    return f"{prefix}_foto_crop_{hashlib.sha1(key.encode('utf-8')).hexdigest()[:10]}"
+
+
+def agent_crop_url(master_url: str, prefix: str, pos_x: int, pos_y: int, zoom: float) -> str:
+    filename = secure_filename(agent_crop_prefix(master_url, prefix, pos_x, pos_y, zoom) + ".jpg")
+    return f"/uploads/{upload_shard(filename)}/{filename}"
+
+
+def render_agent_crop(master_url: str, prefix: str, pos_x: int, pos_y: int, zoom: float, user=None, pid=None):
+    fp = uploaded_url_path(master_url)
+    if not fp:
+        return None
+    with Image.open(fp) as img:
+        content = crop_agent_image(img.convert('RGB'), pos_x, pos_y, zoom)
+    return replace_uploaded_file_from_bytes(content, "crop.jpg", agent_crop_prefix(master_url, prefix, pos_x, pos_y, zoom), user=user, pid=pid)
+
+
+def save_cropped_agent_photo(file_storage, prefix: str, pos_x: int, pos_y: int, zoom: float, user=None, pid=None):
+    if not file_storage or not file_storage.filename:
+        return None, None
+    ok, err = validate_upload(file_storage, ALLOWED_IMAGE_EXT, MAX_IMAGE_MB)
+    if not ok:
+        raise ValueError(err)
+    if Image is None:
+        return save_file(file_storage, f"{prefix}_foto", user=user, pid=pid), None
+    file_storage.stream.seek(0)
+    img = Image.open(file_storage.stream)
+    img = ImageOps.exif_transpose(img).convert('RGB')
+    img.thumbnail((AVATAR_MASTER_PX, AVATAR_MASTER_PX), Image.LANCZOS)
+    bio = BytesIO()
+    img.save(bio, format='JPEG', quality=90, optimize=True)
+    content = bio.getvalue()
+    master_prefix = f"{prefix}_foto_master_{hashlib.sha1(content).hexdigest()[:10]}"
+    master_url = replace_uploaded_file_from_bytes(content, "master.jpg", master_prefix, user=user, pid=pid)
+    return render_agent_crop(master_url, prefix, pos_x, pos_y, zoom, user=user, pid=pid), master_url
+
+
+def recrop_agent_photo(user_id, p_key: str, master_url: str, pos_x: int, pos_y: int, zoom: float):
+    try:
+        prefix = f"u{user_id}_{p_key[1:]}"
+        path = render_agent_crop(master_url, prefix, pos_x, pos_y, zoom)
+        if not path:
+            return
+        clienti = load_db()
+        user = get_user_by_id(clienti, user_id)
+        p = (user or {}).get(p_key) or {}
+        current = (p.get('foto_master'), to_int(p.get('pos_x'), 0), to_int(p.get('pos_y'), 0), to_float(p.get('zoom'), 1.0))
+        if current != (master_url, to_int(pos_x, 0), to_int(pos_y, 0), to_float(zoom, 1.0)):
+            # Parametri cambiati nel frattempo: se ne occupa il job successivo.
+            if not user or p.get('foto') != path:
+                delete_uploaded_url(path)
+            return
+        old_foto = p.get('foto')
+        if old_foto == path:
+            return
+        storage_account(user, p_key, max(stored_size(uploaded_url_path(path)), 0), 1)
+        p['foto'] = path
+        if old_foto and uploaded_url_path(old_foto) != uploaded_url_path(path):
+            delete_uploaded_url(old_foto, user=user, pid=p_key)
+        save_db(clienti)
+    except Exception as e:
+        print(f"Errore ritaglio foto: {e}")
+
+
+def schedule_agent_recrop(user_id, p_key: str, master_url: str, pos_x: int, pos_y: int, zoom: float):
+    threading.Thread(target=recrop_agent_photo, args=(user_id, p_key, master_url, pos_x, pos_y, zoom), daemon=True).start()
 
 
 def get_user_by_id(clienti, user_id):
@@ -619,30 +1077,48 @@ def edit_profile(p_id):
             'es': {'role': request.form.get('role_es', ''), 'bio': request.form.get('bio_es', '')},
             'de': {'role': request.form.get('role_de', ''), 'bio': request.form.get('bio_de', '')},
         }
+        stale = []
+        to_del = request.form.getlist('delete_media')
+        if to_del:
+            removed = [x for x in p.get('gallery_img', []) + p.get('gallery_vid', []) if x in to_del]
+            removed += [x.get('path') for x in p.get('gallery_pdf', []) if x.get('path') in to_del]
+            p['gallery_img'] = [x for x in p.get('gallery_img', []) if x not in to_del]
+            p['gallery_pdf'] = [x for x in p.get('gallery_pdf', []) if x.get('path') not in to_del]
+            p['gallery_vid'] = [x for x in p.get('gallery_vid', []) if x not in to_del]
+            for url in dict.fromkeys(removed):
+                stale.append(release_uploaded_url(url, user=user, pid=p_key))
+        incoming = sum(get_file_size_bytes(f) for key in request.files for f in request.files.getlist(key) if f and f.filename)
+        if incoming and not storage_quota_ok(user, incoming):
+            if save_db(clienti):
+                for url in stale:
+                    delete_uploaded_url(url)
+            flash(f"Spazio esaurito: il limite di {storage_quota_bytes(user) // (1024 * 1024)} MB non consente questo caricamento.", "error")
+            return redirect(url_for('edit_profile', p_id=p_id))
+        recrop = None
         if 'foto' in request.files and request.files['foto'] and request.files['foto'].filename:
             try:
-                old_foto = p.get('foto')
-                path = save_cropped_agent_photo(request.files['foto'], prefix=prefix, pos_x=p['pos_x'], pos_y=p['pos_y'], zoom=p['zoom'])
+                old_foto, old_master = p.get('foto'), p.get('foto_master')
+                path, master = save_cropped_agent_photo(request.files['foto'], prefix=prefix, pos_x=p['pos_x'], pos_y=p['pos_y'], zoom=p['zoom'], user=user, pid=p_key)
                 if path:
                     p['foto'] = path
-                    if old_foto and old_foto != path:
-                        delete_uploaded_url(old_foto)
+                    p['foto_master'] = master or ''
+                    for old in (old_foto, old_master):
+                        if old and uploaded_url_path(old) not in (uploaded_url_path(path), uploaded_url_path(master)):
+                            stale.append(release_uploaded_url(old, user=user, pid=p_key))
             except Exception as e:
                 flash(f"Errore foto profilo: {e}", "error")
                 return redirect(url_for('edit_profile', p_id=p_id))
-        if 'logo' in request.files and request.files['logo'] and request.files['logo'].filename:
-            path = save_file(request.files['logo'], f"{prefix}_logo")
-            if path:
-                p['logo'] = path
-        if 'personal_foto' in request.files and request.files['personal_foto'] and request.files['personal_foto'].filename:
-            path = save_file(request.files['personal_foto'], f"{prefix}_pers")
-            if path:
-                p['personal_foto'] = path
-        to_del = request.form.getlist('delete_media')
-        if to_del:
-            p['gallery_img'] = [x for x in p.get('gallery_img', []) if x not in to_del]
-            p['gallery_pdf'] = [x for x in p.get('gallery_pdf', []) if x.get('path') not in to_del]
-            p['gallery_vid'] = [x for x in p.get('gallery_vid', []) if x not in to_del]
+        elif p.get('foto_master') and Image is not None:
+            if p.get('foto') != agent_crop_url(p['foto_master'], prefix, p['pos_x'], p['pos_y'], p['zoom']):
+                recrop = (user['id'], p_key, p['foto_master'], p['pos_x'], p['pos_y'], p['zoom'])
+        for field, tag in (('logo', 'logo'), ('personal_foto', 'pers')):
+            if field in request.files and request.files[field] and request.files[field].filename:
+                old = p.get(field)
+                path = save_file(request.files[field], f"{prefix}_{tag}", user=user, pid=p_key)
+                if path:
+                    p[field] = path
+                    if old and uploaded_url_path(old) != uploaded_url_path(path):
+                        stale.append(release_uploaded_url(old, user=user, pid=p_key))
         if 'gallery_img' in request.files:
             new_imgs = [f for f in request.files.getlist('gallery_img') if f and f.filename]
             current_count = len(p.get('gallery_img', []))
@@ -654,7 +1130,7 @@ def edit_profile(p_id):
                     flash(err, "error")
                     return redirect(url_for('edit_profile', p_id=p_id))
             for f in imgs_to_upload:
-                path = save_file(f, f"{prefix}_gimg")
+                path = save_file(f, f"{prefix}_gimg", user=user, pid=p_key)
                 if path:
                     p['gallery_img'].append(path)
         if 'gallery_pdf' in request.files:
@@ -668,7 +1144,7 @@ def edit_profile(p_id):
                     flash(err, "error")
                     return redirect(url_for('edit_profile', p_id=p_id))
             for f in pdfs_to_upload:
-                path = save_file(f, f"{prefix}_gpdf")
+                path = save_file(f, f"{prefix}_gpdf", user=user, pid=p_key)
                 if path:
                     p['gallery_pdf'].append({'path': path, 'name': f.filename})
         if 'gallery_vid' in request.files:
@@ -682,31 +1158,180 @@ def edit_profile(p_id):
                     flash(err, "error")
                     return redirect(url_for('edit_profile', p_id=p_id))
             for f in vids_to_upload:
-                path = save_file(f, f"{prefix}_gvid")
+                path = save_file(f, f"{prefix}_gvid", user=user, pid=p_key)
                 if path:
                     p['gallery_vid'].append(path)
         repair_user(user)
-        save_db(clienti)
+        if save_db(clienti):
+            # Un errore di validazione sopra lascia il record invariato: i file si tolgono solo qui.
+            for url in stale:
+                delete_uploaded_url(url)
+        if recrop:
+            schedule_agent_recrop(*recrop)
         flash(f"Profilo P{p_id} salvato correttamente.", "success")
         return redirect(url_for('area'))
     return render_template('edit_card.html', p=user[p_key], p_id=p_id)
 
 
-@app.route('/vcf/<slug>')
-def download_vcf(slug):
+def chunked_upload_error(msg: str, code: int):
+    resp = jsonify({'ok': False, 'error': msg})
+    resp.status_code = code
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
+
+
+@app.route('/area/upload/<p_id>/<kind>', methods=['POST'])
+def chunked_upload_create(p_id, kind):
+    if not session.get('logged_in'):
+        return chunked_upload_error("Sessione scaduta.", 401)
+    cfg = CHUNKED_UPLOAD_KINDS.get(kind)
+    if not cfg or p_id not in ('1', '2', '3'):
+        return chunked_upload_error("Tipo di upload non valido.", 404)
+    user = get_user_by_id(load_db(), session.get('user_id'))
+    if not user:
+        return chunked_upload_error("Utente non trovato.", 401)
+    if user.get('must_change_password'):
+        return chunked_upload_error("Cambia la password prima di caricare file.", 403)
+    data = request.get_json(silent=True) or request.form
+    filename = str(data.get('filename') or '').strip()
+    length = to_int(request.headers.get('Upload-Length') or data.get('size'), 0)
+    if get_file_ext(filename) not in cfg['exts']:
+        return chunked_upload_error(f"Formato non consentito: {filename}", 415)
+    if length <= 0 or length > cfg['max_mb'] * 1024 * 1024:
+        return chunked_upload_error(f"File troppo pesante: {filename} (max {cfg['max_mb']} MB)", 413)
+    if len(user.get('p' + p_id, {}).get(cfg['field']) or []) >= cfg['max_items']:
+        return chunked_upload_error(f"Limite di {cfg['max_items']} file raggiunto.", 409)
+    if not storage_quota_ok(user, length):
+        return chunked_upload_error("Spazio di archiviazione esaurito.", 413)
+    purge_expired_upload_sessions()
+    upload_id = secrets.token_hex(16)
+    open(upload_session_file(upload_id, 'part'), 'wb').close()
+    save_upload_session({
+        'id': upload_id,
+        'user_id': user['id'],
+        'p_id': p_id,
+        'kind': kind,
+        'filename': filename,
+        'length': length,
+        'offset': 0,
+        'created': time.time(),
+    })
+    location = url_for('chunked_upload', upload_id=upload_id)
+    resp = jsonify({'ok': True, 'upload_id': upload_id, 'location': location, 'offset': 0, 'chunk_size': UPLOAD_CHUNK_MB * 1024 * 1024})
+    resp.status_code = 201
+    resp.headers['Location'] = location
+    resp.headers['Upload-Offset'] = '0'
+    resp.headers['Upload-Length'] = str(length)
+    return resp
+
+
+@app.route('/area/upload/<upload_id>', methods=['HEAD', 'GET', 'PATCH', 'DELETE'])
+def chunked_upload(upload_id):
+    if not session.get('logged_in'):
+        return chunked_upload_error("Sessione scaduta.", 401)
+    meta = load_upload_session(upload_id)
+    if not meta or meta.get('user_id') != session.get('user_id'):
+        return chunked_upload_error("Upload non trovato.", 404)
+    part_path = upload_session_file(upload_id, 'part')
+    try:
+        offset = os.path.getsize(part_path)
+    except OSError:
+        drop_upload_session(upload_id)
+        return chunked_upload_error("Upload non trovato.", 404)
+    if request.method == 'DELETE':
+        drop_upload_session(upload_id)
+        return '', 204
+    if request.method in ('HEAD', 'GET'):
+        resp = jsonify({'ok': True, 'offset': offset, 'length': meta['length']})
+        resp.headers['Upload-Offset'] = str(offset)
+        resp.headers['Upload-Length'] = str(meta['length'])
+        resp.headers['Cache-Control'] = 'no-store'
+        return resp
+    if to_int(request.headers.get('Upload-Offset'), -1) != offset:
+        resp = chunked_upload_error("Offset non valido.", 409)
+        resp.headers['Upload-Offset'] = str(offset)
+        return resp
+    if (request.content_length or 0) > UPLOAD_CHUNK_MB * 1024 * 1024:
+        return chunked_upload_error(f"Blocco troppo grande (max {UPLOAD_CHUNK_MB} MB).", 413)
+    try:
+        checksum, expected = parse_upload_checksum(request.headers.get('Upload-Checksum', ''))
+    except Exception:
+        return chunked_upload_error(f"Checksum non supportato (ammessi: {', '.join(UPLOAD_CHECKSUM_ALGOS)}).", 400)
+    written = 0
+    with open(part_path, 'r+b') as f:
+        f.seek(offset)
+        while True:
+            block = request.stream.read(64 * 1024)
+            if not block:
+                break
+            written += len(block)
+            if offset + written > meta['length']:
+                f.truncate(offset)
+                return chunked_upload_error("Il blocco supera la dimensione dichiarata.", 413)
+            if checksum:
+                checksum.update(block)
+            f.write(block)
+        if checksum and not secrets.compare_digest(checksum.digest(), expected):
+            f.truncate(offset)
+            resp = chunked_upload_error("Checksum del blocco non valido.", 460)
+            resp.headers['Upload-Offset'] = str(offset)
+            return resp
+    offset += written
+    meta['offset'] = offset
+    save_upload_session(meta)
+    if offset < meta['length']:
+        resp = make_response('', 204)
+        resp.headers['Upload-Offset'] = str(offset)
+        return resp
+    return finalize_chunked_upload(meta, part_path)
+
+
+def finalize_chunked_upload(meta: dict, part_path: str):
+    cfg = CHUNKED_UPLOAD_KINDS[meta['kind']]
     clienti = load_db()
-    user = next((c for c in clienti if c.get('slug') == slug), None)
+    user = get_user_by_id(clienti, meta['user_id'])
     if not user:
-        return "Contatto non trovato", 404
-    if repair_user(user):
-        save_db(clienti)
-    p_req = (request.args.get('p') or '').strip().lower()
+        drop_upload_session(meta['id'])
+        return chunked_upload_error("Utente non trovato.", 404)
+    if user.get('must_change_password'):
+        return chunked_upload_error("Cambia la password prima di caricare file.", 403)
+    repair_user(user)
+    p = user['p' + meta['p_id']]
+    if len(p.get(cfg['field']) or []) >= cfg['max_items']:
+        drop_upload_session(meta['id'])
+        return chunked_upload_error(f"Limite di {cfg['max_items']} file raggiunto.", 409)
+    prefix = f"u{user['id']}_{meta['p_id']}_{cfg['tag']}"
+    dest, path = upload_target(secure_filename(f"{prefix}_{meta['filename']}"))
+    old_size = stored_size(dest)
+    # Sessioni parallele o aperte prima di un cambio di quota: si ricontrolla sul totale attuale.
+    if not storage_quota_ok(user, meta['offset'] - max(old_size, 0)):
+        drop_upload_session(meta['id'])
+        return chunked_upload_error("Spazio di archiviazione esaurito.", 413)
+    os.replace(part_path, dest)
+    drop_upload_session(meta['id'])
+    storage_account(user, 'p' + meta['p_id'], meta['offset'] - max(old_size, 0), 0 if old_size >= 0 else 1)
+    if meta['kind'] == 'pdf':
+        p[cfg['field']].append({'path': path, 'name': meta['filename']})
+    else:
+        p[cfg['field']].append(path)
+    save_db(clienti)
+    resp = jsonify({'ok': True, 'done': True, 'path': path})
+    resp.headers['Upload-Offset'] = str(meta['offset'])
+    return resp
+
+
+def resolve_vcf_profile(user, p_req: str) -> str:
+    p_req = (p_req or '').strip().lower()
     if p_req not in ('p1', 'p2', 'p3'):
         p_req = user.get('default_profile', 'p1')
     if p_req == 'menu':
         p_req = 'p1'
     if not user.get(p_req, {}).get('active'):
         p_req = 'p1'
+    return p_req
+
+
+def build_vcf(user, slug: str, p_req: str) -> str:
     p = user.get(p_req, {}) or {}
     full_name = (p.get('name') or user.get('nome') or slug).strip()
     role = (p.get('role') or '').strip()
@@ -722,7 +1347,7 @@ def download_vcf(slug):
     websites = [normalize_web_url(x) for x in (p.get('websites') or []) if str(x).strip()]
     socials = [normalize_web_url((s or {}).get('url', '')) for s in (p.get('socials') or []) if normalize_web_url((s or {}).get('url', ''))]
     photo_url = absolute_url(p.get('foto') or '')
-    card_url = f"{CARD_BASE_URL}/card/{slug}?p={p_req}"
+    card_url = f"{CARD_BASE_URL}/card/{slug}/{p_req}/"
     gallery_img = [absolute_url(x) for x in (p.get('gallery_img') or []) if absolute_url(x)]
     gallery_vid = [absolute_url(x) for x in (p.get('gallery_vid') or []) if absolute_url(x)]
     gallery_pdf = [absolute_url((x or {}).get('path', '')) for x in (p.get('gallery_pdf') or []) if absolute_url((x or {}).get('path', ''))]
@@ -777,7 +1402,21 @@ def download_vcf(slug):
     if notes:
         vcf_lines.append(f"NOTE:{vcf_escape(chr(10).join(notes))}")
     vcf_lines.append('END:VCARD')
-    vcf_content = '\r\n'.join(vcf_lines) + '\r\n'
+    return '\r\n'.join(vcf_lines) + '\r\n'
+
+
+@app.route('/vcf/<slug>')
+def download_vcf(slug):
+    if not slug_exists(slug):
+        return "Contatto non trovato", 404
+    clienti = load_db()
+    user = next((c for c in clienti if c.get('slug') == slug), None)
+    if not user:
+        return "Contatto non trovato", 404
+    if repair_user(user):
+        save_db(clienti)
+    p_req = resolve_vcf_profile(user, request.args.get('p'))
+    vcf_content = build_vcf(user, slug, p_req)
     filename = f"{slug}-{p_req}.vcf"
     resp = make_response(vcf_content)
     resp.headers['Content-Type'] = 'text/vcard; charset=utf-8'
@@ -786,23 +1425,37 @@ def download_vcf(slug):
 
 
 @app.route('/card/<slug>')
-def view_card(slug):
+@app.route('/card/<slug>/<any(p1, p2, p3):p_req>/')
+@app.route('/card/<slug>/<any(en, fr, es, de):lang>/')
+@app.route('/card/<slug>/<any(p1, p2, p3):p_req>/<any(en, fr, es, de):lang>/')
+def view_card(slug, p_req=None, lang=None):
+    if not slug_exists(slug):
+        return "<h1>Card non trovata</h1>", 404
     clienti = load_db()
     user = next((c for c in clienti if c.get('slug') == slug), None)
     if not user:
         return "<h1>Card non trovata</h1>", 404
     if repair_user(user):
         save_db(clienti)
-    default_p = user.get('default_profile', 'p1')
-    p_req = request.args.get('p')
+    template, ctx = card_template_context(user, slug, p_req or request.args.get('p'), lang or detect_lang_from_request())
+    return render_template(template, offline=True, **ctx)
+
+
+def card_template_context(user, slug: str, p_req: str, lang: str, static_export: bool = False):
     if not p_req:
-        p_req = default_p
-    lang = detect_lang_from_request()
+        p_req = user.get('default_profile', 'p1')
     ui = ui_labels_for_lang(lang)
+    # URL a percorso: funzionano sia sull'app sia sull'export statico, dove la query ?p= viene ignorata.
+    lang_part = '' if not static_export or lang == 'it' else f"{lang}/"
+    profile_urls = {pid: f"/card/{slug}/{pid}/{lang_part}" for pid in ('p1', 'p2', 'p3')}
     if p_req == 'menu':
-        return render_template('menu_card.html', user=user, slug=slug, lang=lang, ui=ui)
+        return 'menu_card.html', dict(user=user, slug=slug, lang=lang, ui=ui, profile_urls=profile_urls)
     if not user.get(p_req, {}).get('active'):
         p_req = 'p1'
+    share_url = f"{CARD_BASE_URL}/card/{slug}/{p_req}/"
+    # L'export include i PNG dei QR: le pagine statiche non dipendono dal servizio esterno.
+    qr_url = f"/qr/{slug}-{p_req}.png" if static_export and qrcode is not None else ''
+    lang_urls = {code: f"/card/{slug}/{p_req}/" + ('' if code == 'it' else f"{code}/") for code in EXPORT_LANGS}
     p = user[p_req]
     ag = {
         'name': p.get('name'),
@@ -822,12 +1475,130 @@ def view_card(slug):
         'fx_rotate_agent': p.get('fx_rotate_agent'),
         'fx_interaction': p.get('fx_interaction'),
         'fx_back': p.get('fx_back_content'),
-        'photo_pos_x': p.get('pos_x', 0),
-        'photo_pos_y': p.get('pos_y', 0),
-        'photo_zoom': p.get('zoom', 1.0),
+        'photo_pos_x': 0 if p.get('foto_master') else p.get('pos_x', 0),
+        'photo_pos_y': 0 if p.get('foto_master') else p.get('pos_y', 0),
+        'photo_zoom': 1.0 if p.get('foto_master') else p.get('zoom', 1.0),
         'trans': p.get('trans', {})
     }
-    return render_template('card.html', lang=lang, ui=ui, ag=ag, mobiles=p.get('mobiles', []), emails=p.get('emails', []), websites=p.get('websites', []), socials=p.get('socials', []), p_data=p, profile=p_req, p2_enabled=user['p2']['active'], p3_enabled=user['p3']['active'])
+    vcf_url = f"/vcf/{slug}-{p_req}.vcf" if static_export else f"/vcf/{slug}?p={p_req}"
+    gallery = {kind: gallery_page(p, kind, 0, paged=not static_export) for kind in GALLERY_FIELDS}
+    return 'card.html', dict(lang=lang, ui=ui, ag=ag, mobiles=p.get('mobiles', []), emails=p.get('emails', []), websites=p.get('websites', []), socials=p.get('socials', []), p_data=p, profile=p_req, p2_enabled=user['p2']['active'], p3_enabled=user['p3']['active'], profile_urls=profile_urls, vcf_url=vcf_url, gallery=gallery, share_url=share_url, qr_url=qr_url, lang_urls=lang_urls)
+
+
+def gallery_page(p, kind: str, page: int, paged: bool = True) -> dict:
+    items = list(p.get(GALLERY_FIELDS[kind]) or [])
+    if kind == 'pdf':
+        items = [{'path': (x or {}).get('path', ''), 'name': (x or {}).get('name', '')} for x in items]
+    if not paged:
+        return {'items': items, 'page': 0, 'next_page': None, 'total': len(items)}
+    size = GALLERY_PAGE_SIZE[kind]
+    start = page * size
+    next_page = page + 1 if start + size < len(items) else None
+    return {'items': items[start:start + size], 'page': page, 'next_page': next_page, 'total': len(items)}
+
+
+@app.route('/card/<slug>/gallery/<p_req>/<kind>')
+def card_gallery(slug, p_req, kind):
+    if kind not in GALLERY_FIELDS or p_req not in ('p1', 'p2', 'p3'):
+        return jsonify({'items': [], 'next_page': None}), 404
+    if not slug_exists(slug):
+        return jsonify({'items': [], 'next_page': None}), 404
+    user = next((c for c in load_db() if c.get('slug') == slug), None)
+    if not user or not user.get(p_req, {}).get('active'):
+        return jsonify({'items': [], 'next_page': None}), 404
+    page = max(0, to_int(request.args.get('page'), 0))
+    resp = jsonify(gallery_page(user[p_req], kind, page))
+    resp.headers['Cache-Control'] = 'public, max-age=60'
+    return resp
+
+
+def active_profile_ids(user) -> list:
+    pids = [pid for pid in ('p1', 'p2', 'p3') if (user.get(pid) or {}).get('active')]
+    return pids or ['p1']
+
+
+def card_offline_assets(user, slug: str) -> list:
+    card_url = f"/card/{slug}"
+    assets = [card_url, '/static/card.css', url_for('card_manifest', slug=slug)]
+    for pid in active_profile_ids(user):
+        p = user.get(pid) or {}
+        assets.append(f"{card_url}/{pid}/")
+        assets.append(f"/vcf/{slug}?p={pid}")
+        for key in ('foto', 'logo', 'personal_foto'):
+            if p.get(key) and p[key] not in assets:
+                assets.append(p[key])
+    return assets
+
+
+def card_offline_version(user, assets: list) -> str:
+    payload = {
+        'assets': assets,
+        'default_profile': user.get('default_profile'),
+        'profiles': {pid: user.get(pid) for pid in active_profile_ids(user)},
+    }
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=record_json_default)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:12]
+
+
+@app.route('/card/<slug>/sw.js')
+def card_service_worker(slug):
+    if not slug_exists(slug):
+        return "// card non trovata", 404, {'Content-Type': 'application/javascript; charset=utf-8'}
+    user = next((c for c in load_db() if c.get('slug') == slug), None)
+    if not user:
+        return "// card non trovata", 404, {'Content-Type': 'application/javascript; charset=utf-8'}
+    repair_user(user)
+    assets = card_offline_assets(user, slug)
+    js = render_template(
+        'card_sw.js',
+        slug=slug,
+        scope=f"/card/{slug}",
+        assets=assets,
+        version=card_offline_version(user, assets),
+        revalidate_ms=CARD_SW_REVALIDATE_SECONDS * 1000,
+        cdn_hosts=list(CARD_SW_CDN_HOSTS),
+    )
+    resp = make_response(js)
+    resp.headers['Content-Type'] = 'application/javascript; charset=utf-8'
+    resp.headers['Service-Worker-Allowed'] = f"/card/{slug}"
+    # La pagina registra con updateViaCache 'all': le riaperture entro max-age non contattano il server.
+    resp.headers['Cache-Control'] = f'public, max-age={CARD_SW_MAX_AGE}'
+    resp.set_etag(hashlib.sha1(js.encode('utf-8')).hexdigest()[:16])
+    return resp.make_conditional(request)
+
+
+@app.route('/card/<slug>/manifest.webmanifest')
+def card_manifest(slug):
+    if not slug_exists(slug):
+        return "Card non trovata", 404
+    user = next((c for c in load_db() if c.get('slug') == slug), None)
+    if not user:
+        return "Card non trovata", 404
+    repair_user(user)
+    p = user.get(user.get('default_profile')) or user['p1']
+    if not p.get('active'):
+        p = user['p1']
+    name = (p.get('name') or user.get('nome') or slug).strip()
+    icons = []
+    if p.get('foto'):
+        icons.append({'src': p['foto'], 'sizes': '800x800', 'type': 'image/jpeg', 'purpose': 'any'})
+    icons.append({'src': '/static/pay4you-logo.png', 'sizes': '1024x1536', 'type': 'image/png', 'purpose': 'any'})
+    manifest = {
+        'id': f"/card/{slug}",
+        'name': name,
+        'short_name': name[:12] or 'Pay4You',
+        'description': (p.get('company') or p.get('role') or 'Pay4You Card').strip(),
+        'start_url': f"/card/{slug}",
+        'scope': f"/card/{slug}",
+        'display': 'standalone',
+        'background_color': '#050505',
+        'theme_color': '#050505',
+        'icons': icons,
+    }
+    resp = make_response(json.dumps(manifest, ensure_ascii=False))
+    resp.headers['Content-Type'] = 'application/manifest+json; charset=utf-8'
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
 
 
 @app.route('/master', methods=['GET', 'POST'])
@@ -840,7 +1611,8 @@ def master_login():
                 dirty = True
         if dirty:
             save_db(clienti)
-        return render_template('master_dashboard.html', clienti=clienti, files=[])
+        storage_total = sum(storage_counters(c).get('bytes', 0) for c in clienti)
+        return render_template('master_dashboard.html', clienti=clienti, files=[], storage_total=storage_total)
 
     if request.method == 'POST' and request.form.get('username') == 'admin' and request.form.get('password') == 'Peppone16@':
         session['is_master'] = True
@@ -865,7 +1637,7 @@ def master_add():
         return redirect(url_for('master_login'))
     password = make_random_password(12)
     new_id = max([c['id'] for c in clienti], default=0) + 1
-    new_client = {
+    new_client = Client({
         'id': new_id,
         'slug': slug,
         'username': slug,
@@ -879,8 +1651,7 @@ def master_add():
         'p2': {'active': False},
         'p3': {'active': False},
         'default_profile': 'p1'
-    }
-    repair_user(new_client)
+    })
     clienti.append(new_client)
     save_db(clienti)
     flash(f"Card '{slug}' creata con successo!", 'success')
@@ -892,9 +1663,7 @@ def legacy_card_redirect(slug):
     reserved = {'area', 'master', 'uploads', 'static', 'favicon.ico', 'reset-tutto', 'vcf', 'card'}
     if slug in reserved:
         return redirect(url_for('home'))
-    clienti = load_db()
-    user = next((c for c in clienti if c.get('slug') == slug), None)
-    if user:
+    if slug_exists(slug):
         p = request.args.get('p', '')
         if p:
             return redirect(url_for('view_card', slug=slug, p=p), code=301)
@@ -918,6 +1687,95 @@ def master_impersonate(id):
     return redirect(url_for('area'))
 
 
+class ZipStreamBuffer:
+    # File-like non seekable: zipfile scrive qui e lo stream svuota a ogni chunk.
+    def __init__(self):
+        self.chunks = []
+        self.pos = 0
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        self.pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.pos
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        out = b''.join(self.chunks)
+        self.chunks = []
+        return out
+
+
+def client_export_json(user) -> str:
+    data = record_json(user)
+    for key in ('password', 'reset_token', 'reset_expires'):
+        data.pop(key, None)
+    return json.dumps(data, ensure_ascii=False, indent=2)
+
+
+def stream_client_zip(user):
+    slug = user['slug']
+    buf = ZipStreamBuffer()
+    with zipfile.ZipFile(buf, 'w') as zf:
+        zf.writestr(f"{slug}/client.json", client_export_json(user), compress_type=zipfile.ZIP_DEFLATED)
+        for pid in active_profile_ids(user):
+            zf.writestr(f"{slug}/vcard/{slug}-{pid}.vcf", build_vcf(user, slug, pid), compress_type=zipfile.ZIP_DEFLATED)
+        yield buf.take()
+        for url in client_media_urls(user):
+            fp = uploaded_url_path(url)
+            if not fp:
+                continue
+            rel = os.path.relpath(fp, app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+            try:
+                # Il file può sparire tra risoluzione e stat (cancellazione o reencode in corso).
+                zinfo = zipfile.ZipInfo.from_file(fp, f"{slug}/uploads/{rel}")
+                zinfo.compress_type = zipfile.ZIP_STORED
+                with open(fp, 'rb') as src, zf.open(zinfo, 'w') as dst:
+                    while True:
+                        chunk = src.read(1024 * 1024)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                        yield buf.take()
+            except OSError:
+                continue
+    yield buf.take()
+
+
+def client_zip_response(user):
+    resp = Response(stream_with_context(stream_client_zip(user)), mimetype='application/zip')
+    resp.headers['Content-Disposition'] = f'attachment; filename="{user["slug"]}-export.zip"'
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
+
+
+@app.route('/master/export/<int:id>')
+def master_export(id):
+    if not session.get('is_master'):
+        return redirect(url_for('master_login'))
+    user = next((c for c in load_db() if c.get('id') == id), None)
+    if not user:
+        flash('Card non trovata.', 'error')
+        return redirect(url_for('master_login'))
+    return client_zip_response(user)
+
+
+@app.route('/area/export')
+def area_export():
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    user = next((c for c in load_db() if c.get('id') == session.get('user_id')), None)
+    if not user:
+        return redirect(url_for('logout'))
+    if user.get('must_change_password'):
+        return redirect(url_for('change_password'))
+    return client_zip_response(user)
+
+
 @app.route('/master/logout')
 def master_logout():
     session.pop('is_master', None)
@@ -933,9 +1791,12 @@ def logout():
     return redirect(url_for('login'))
 
 
-@app.route('/uploads/<filename>')
+@app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    rel = resolve_upload_rel(filename)
+    if not rel:
+        return "File non trovato", 404
+    return send_from_directory(app.config['UPLOAD_FOLDER'], rel)
 
 
 @app.route('/favicon.ico')
@@ -954,5 +1815,486 @@ def reset_db_emergency():
     return 'DB PULITO'
 
 
+EXPORT_LANGS = ["it", "en", "fr", "es", "de"]
+EXPORT_STATIC_FILES = ['card.css', 'favicon.ico', 'pay4you-logo.png']
+EXPORT_TEMPLATES = ['card.html', 'menu_card.html']
+# Regole che il server statico deve applicare per servire i link pubblici esistenti
+# (copiate anche in manifest.json). Esempio nginx:
+#   if ($arg_p ~ ^p[123]$) { rewrite ^/card/([^/]+)/?$ /card/$1/$arg_p/? last; }
+#   if ($arg_p ~ ^p[123]$) { rewrite ^/vcf/([^/]+)$ /vcf/$1-$arg_p.vcf? last; }
+#   map $http_accept_language $card_lang { ~^(en|fr|es|de) $1/; default ""; }
+#   location ~ ^/card/[^/]+/(p[123]/)?$ { try_files $uri$card_lang $uri =404; }
+#   location /vcf/ { default_type "text/vcard; charset=utf-8"; }
+EXPORT_REWRITES = [
+    {'from': '/card/<slug>?p=<pid>', 'to': '/card/<slug>/<pid>/'},
+    {'from': '/vcf/<slug>?p=<pid>', 'to': '/vcf/<slug>-<pid>.vcf'},
+    {'from': '/card/<slug>/[<pid>/] con Accept-Language en|fr|es|de', 'to': '/card/<slug>/[<pid>/]<lang>/'},
+    {'from': '/vcf/*', 'header': 'Content-Type: text/vcard; charset=utf-8'},
+]
+
+
+def write_export_file(out_dir: str, rel_path: str, content):
+    fp = os.path.join(out_dir, rel_path)
+    os.makedirs(os.path.dirname(fp), exist_ok=True)
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    tmp = fp + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, fp)
+    return rel_path
+
+
+def link_export_file(out_dir: str, src: str, rel_path: str):
+    dst = os.path.join(out_dir, rel_path)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        st = os.stat(src)
+        dst_st = os.stat(dst)
+        if dst_st.st_ino == st.st_ino or (dst_st.st_size == st.st_size and dst_st.st_mtime >= st.st_mtime):
+            return rel_path
+        os.remove(dst)
+    except OSError:
+        pass
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return rel_path
+
+
+def qr_png_bytes(url: str):
+    if qrcode is None:
+        return None
+    bio = BytesIO()
+    qrcode.make(url).save(bio, format='PNG')
+    return bio.getvalue()
+
+
+def client_media_urls(user) -> list:
+    urls = []
+    for pid in ('p1', 'p2', 'p3'):
+        p = user.get(pid) or {}
+        for key in ('foto', 'foto_master', 'logo', 'personal_foto'):
+            if p.get(key):
+                urls.append(p[key])
+        urls.extend(p.get('gallery_img') or [])
+        urls.extend(p.get('gallery_vid') or [])
+        urls.extend((x or {}).get('path', '') for x in (p.get('gallery_pdf') or []))
+    return [u for u in dict.fromkeys(urls) if u]
+
+
+def rewrite_client_media(user, fn) -> bool:
+    changed = False
+    for pid in ('p1', 'p2', 'p3'):
+        p = user.get(pid) or {}
+        for key in ('foto', 'foto_master', 'logo', 'personal_foto'):
+            if p.get(key):
+                new = fn(p[key])
+                if new != p[key]:
+                    p[key] = new
+                    changed = True
+        for key in ('gallery_img', 'gallery_vid'):
+            items = p.get(key) or []
+            new_items = [fn(x) for x in items]
+            if new_items != items:
+                p[key] = new_items
+                changed = True
+        for item in p.get('gallery_pdf') or []:
+            if item and item.get('path'):
+                new = fn(item['path'])
+                if new != item['path']:
+                    item['path'] = new
+                    changed = True
+    return changed
+
+
+def export_client(user, out_dir: str) -> list:
+    slug = user['slug']
+    files = []
+    pids = active_profile_ids(user)
+    default_p = user.get('default_profile', 'p1')
+    for lang in EXPORT_LANGS:
+        lang_part = '' if lang == 'it' else f"{lang}/"
+        for p_req, rel_dir in [(default_p, f"card/{slug}/{lang_part}")] + [(pid, f"card/{slug}/{pid}/{lang_part}") for pid in pids]:
+            with app.test_request_context(f"/{rel_dir}", base_url=CARD_BASE_URL, headers={'Accept-Language': lang}):
+                template, ctx = card_template_context(user, slug, p_req, lang, static_export=True)
+                html = render_template(template, offline=False, **ctx)
+            files.append(write_export_file(out_dir, rel_dir + 'index.html', html))
+    vcf_default = resolve_vcf_profile(user, default_p)
+    for pid in pids:
+        vcf = build_vcf(user, slug, pid)
+        files.append(write_export_file(out_dir, f"vcf/{slug}-{pid}.vcf", vcf))
+        if pid == vcf_default:
+            files.append(write_export_file(out_dir, f"vcf/{slug}.vcf", vcf))
+            files.append(write_export_file(out_dir, f"vcf/{slug}", vcf))
+        png = qr_png_bytes(f"{CARD_BASE_URL}/card/{slug}/{pid}/")
+        if png:
+            files.append(write_export_file(out_dir, f"qr/{slug}-{pid}.png", png))
+    png = qr_png_bytes(f"{CARD_BASE_URL}/card/{slug}")
+    if png:
+        files.append(write_export_file(out_dir, f"qr/{slug}.png", png))
+    for url in client_media_urls(user):
+        src = uploaded_url_path(url)
+        if src and os.path.isfile(src):
+            files.append(link_export_file(out_dir, src, urlparse(url).path.lstrip('/')))
+    return files
+
+
+def export_static_site(out_dir: str, full: bool = False) -> dict:
+    manifest_path = os.path.join(out_dir, 'manifest.json')
+    previous = {}
+    if not full and os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                previous = json.load(f)
+        except Exception:
+            previous = {}
+    render_sig = hashlib.sha1()
+    for name in EXPORT_TEMPLATES:
+        with open(os.path.join(app.root_path, app.template_folder, name), 'rb') as f:
+            render_sig.update(f.read())
+    render_sig.update(CARD_BASE_URL.encode('utf-8'))
+    render_version = render_sig.hexdigest()
+    old_clients = previous.get('clients', {}) if previous.get('render_version') == render_version else {}
+    for name in EXPORT_STATIC_FILES:
+        src = os.path.join(app.root_path, 'static', name)
+        if os.path.isfile(src):
+            link_export_file(out_dir, src, f"static/{name}")
+    stats = {'exported': 0, 'skipped': 0, 'removed': 0}
+    clients = {}
+    for user in load_db():
+        repair_user(user)
+        if not user.get('slug'):
+            continue
+        key = str(user.get('id'))
+        raw = json.dumps(user, sort_keys=True, ensure_ascii=False, default=record_json_default)
+        fingerprint = hashlib.sha1(raw.encode('utf-8')).hexdigest()
+        old = old_clients.get(key)
+        if old and old.get('fingerprint') == fingerprint and all(os.path.exists(os.path.join(out_dir, x)) for x in old.get('files', [])):
+            clients[key] = old
+            stats['skipped'] += 1
+            continue
+        files = export_client(user, out_dir)
+        clients[key] = {'slug': user['slug'], 'fingerprint': fingerprint, 'files': files}
+        stats['exported'] += 1
+    kept = {x for c in clients.values() for x in c['files']}
+    for key, old in previous.get('clients', {}).items():
+        for rel in old.get('files', []):
+            if rel not in kept:
+                try:
+                    os.remove(os.path.join(out_dir, rel))
+                    stats['removed'] += 1
+                except OSError:
+                    pass
+    write_export_file(out_dir, 'manifest.json', json.dumps({
+        'generated_at': int(time.time()),
+        'base_url': CARD_BASE_URL,
+        'render_version': render_version,
+        'langs': EXPORT_LANGS,
+        'rewrites': EXPORT_REWRITES,
+        'clients': clients,
+    }, indent=2, ensure_ascii=False))
+    return stats
+
+
+@app.cli.command('export-static')
+@click.option('--out', 'out_dir', default=STATIC_EXPORT_DIR, show_default=True, help='Cartella di destinazione.')
+@click.option('--full', is_flag=True, help='Riesporta tutti i clienti ignorando il manifest precedente.')
+def export_static_command(out_dir, full):
+    """Esporta tutte le card attive come sito statico."""
+    os.makedirs(out_dir, exist_ok=True)
+    stats = export_static_site(out_dir, full=full)
+    click.echo(f"Export completato in {out_dir}: {stats['exported']} clienti esportati, {stats['skipped']} invariati, {stats['removed']} file rimossi.")
+
+
+def reconcile_client_storage(user) -> dict:
+    fresh = {'bytes': 0, 'files': 0, 'profiles': {}}
+    for pid in ('p1', 'p2', 'p3'):
+        p = user.get(pid) or {}
+        counters = {'bytes': 0, 'files': 0}
+        urls = [p.get(k) for k in ('foto', 'foto_master', 'logo', 'personal_foto')]
+        urls += list(p.get('gallery_img') or []) + list(p.get('gallery_vid') or [])
+        urls += [(x or {}).get('path') for x in (p.get('gallery_pdf') or [])]
+        seen = set()
+        for url in urls:
+            fp = uploaded_url_path(url)
+            if not fp or fp in seen:
+                continue
+            seen.add(fp)
+            size = stored_size(fp)
+            if size >= 0:
+                counters['bytes'] += size
+                counters['files'] += 1
+        fresh['profiles'][pid] = counters
+        fresh['bytes'] += counters['bytes']
+        fresh['files'] += counters['files']
+    return fresh
+
+
+@app.cli.command('reconcile-storage')
+def reconcile_storage_command():
+    """Ricalcola i contatori di spazio per cliente dai file realmente presenti."""
+    clienti = load_db()
+    drifted = 0
+    for c in clienti:
+        fresh = reconcile_client_storage(c)
+        old = storage_counters(c)
+        old_profiles = {pid: storage_counters(c, pid) for pid in fresh['profiles']}
+        if old.get('bytes') != fresh['bytes'] or old.get('files') != fresh['files'] or old_profiles != fresh['profiles']:
+            drifted += 1
+            click.echo(f"{c.get('slug')}: {old.get('bytes', 0)} -> {fresh['bytes']} byte, {old.get('files', 0)} -> {fresh['files']} file")
+            c['storage'] = fresh
+    if drifted:
+        save_db(clienti)
+    click.echo(f"Clienti corretti: {drifted} su {len(clienti)}.")
+
+
+def sharded_upload_url(url: str) -> str:
+    parsed = urlparse(str(url or '')).path
+    if not parsed.startswith('/uploads/'):
+        return url
+    rel = parsed.split('/uploads/', 1)[1]
+    if '/' in rel or not rel:
+        return url
+    return f"/uploads/{upload_shard(rel)}/{rel}"
+
+
+@app.cli.command('migrate-uploads')
+@click.option('--dry-run', is_flag=True, help='Mostra cosa verrebbe spostato senza modificare nulla.')
+def migrate_uploads_command(dry_run):
+    """Sposta gli upload piatti nelle sottocartelle shard e aggiorna gli URL dei clienti."""
+    moved = 0
+    with os.scandir(app.config['UPLOAD_FOLDER']) as it:
+        entries = [e for e in it if e.is_file()]
+    for entry in entries:
+        dest = os.path.join(app.config['UPLOAD_FOLDER'], upload_shard(entry.name), entry.name)
+        if not dry_run:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(entry.path, dest)
+        moved += 1
+    # I vecchi URL restano serviti da resolve_upload_rel, quindi i record si aggiornano dopo lo spostamento.
+    clienti = load_db()
+    rewritten = sum(1 for c in clienti if rewrite_client_media(c, sharded_upload_url))
+    if not dry_run and rewritten:
+        save_db(clienti)
+    prefix = "[dry-run] " if dry_run else ""
+    click.echo(f"{prefix}File spostati: {moved}. Clienti aggiornati: {rewritten}.")
+
+
+def reencode_image_file(job: dict) -> dict:
+    # Gira in un processo del pool: lavora solo sui file, il DB lo aggiorna il processo principale.
+    res = dict(job, new_url=None, old_size=stored_size(job['src']), new_size=0, error='')
+    try:
+        with Image.open(job['src']) as img:
+            fmt = img.format
+            img = ImageOps.exif_transpose(img)
+            alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+            icc = img.info.get('icc_profile')
+            resized = max(img.size) > job['max_px']
+            if resized:
+                img.thumbnail((job['max_px'], job['max_px']), Image.LANCZOS)
+            bio = BytesIO()
+            if alpha and not job['master']:
+                img.save(bio, format='PNG', optimize=True, icc_profile=icc)
+                ext = 'png'
+            elif fmt == 'WEBP' and not job['master']:
+                img.save(bio, format='WEBP', quality=job['quality'], method=6, icc_profile=icc)
+                ext = 'webp'
+            else:
+                img.convert('RGB').save(bio, format='JPEG', quality=90 if job['master'] else job['quality'], optimize=True, progressive=True, icc_profile=icc)
+                ext = 'jpg'
+        content = bio.getvalue()
+        saved = res['old_size'] - len(content)
+        if not job['master'] and saved < res['old_size'] * REENCODE_MIN_SAVING and not (resized and saved > 0):
+            return res
+        name = secure_filename(f"{job['stem']}{hashlib.sha1(content).hexdigest()[:10]}.{ext}")
+        rel = f"{upload_shard(name)}/{name}"
+        dest = os.path.join(job['upload_folder'], rel)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with open(dest + '.tmp', 'wb') as f:
+            f.write(content)
+        os.replace(dest + '.tmp', dest)
+        res['new_url'] = f"/uploads/{rel}"
+        res['new_size'] = len(content)
+    except Exception as e:
+        res['error'] = str(e)
+    return res
+
+
+def reencode_jobs(user) -> list:
+    jobs, seen = [], set()
+    base = {'client': user['id'], 'max_px': REENCODE_MAX_PX, 'quality': REENCODE_QUALITY, 'upload_folder': app.config['UPLOAD_FOLDER']}
+    for pid in ('p1', 'p2', 'p3'):
+        p = user.get(pid) or {}
+        # Foto caricate prima dei master: il master si ricava dall'immagine attuale.
+        src = uploaded_url_path(p.get('foto')) if not p.get('foto_master') else None
+        if src:
+            jobs.append(dict(base, pid=pid, url=p['foto'], src=src, master=True, stem=f"u{user['id']}_{pid[1:]}_foto_master_",
+                             crop=(p['pos_x'], p['pos_y'], p['zoom'])))
+        for url in [p.get('logo'), p.get('personal_foto')] + list(p.get('gallery_img') or []):
+            if not url or url in seen:
+                continue
+            seen.add(url)
+            src = uploaded_url_path(url)
+            if src and get_file_ext(src) in ALLOWED_IMAGE_EXT:
+                stem = re.sub(r'_r[0-9a-f]{10}$', '', os.path.splitext(os.path.basename(src))[0])
+                jobs.append(dict(base, pid=pid, url=url, src=src, master=False, stem=f"{stem}_r"))
+    return jobs
+
+
+def load_reencode_checkpoint(path: str) -> dict:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if isinstance(data.get('done'), dict):
+            return data
+    except Exception:
+        pass
+    return {'done': {}}
+
+
+def save_reencode_checkpoint(path: str, checkpoint: dict):
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f, separators=(',', ':'))
+    os.replace(path + '.tmp', path)
+
+
+def apply_reencode_results(batch: dict, checkpoint: dict, checkpoint_path: str) -> list:
+    # I ritagli si generano prima di leggere il DB: tra load_db e save_db solo lo scambio dei puntatori.
+    for results in batch.values():
+        for r in results:
+            if r['master'] and r['new_url']:
+                r['crop_url'] = render_agent_crop(r['new_url'], f"u{r['client']}_{r['pid'][1:]}", *r['crop'])
+                r['crop_size'] = max(stored_size(uploaded_url_path(r['crop_url'])), 0) if r['crop_url'] else 0
+    clienti = load_db()
+    stale, created, report = [], [], []
+    for cid, results in batch.items():
+        user = get_user_by_id(clienti, cid)
+        saved = files = 0
+        for r in results:
+            if not r['new_url']:
+                continue
+            new_files = [u for u in (r['new_url'], r.get('crop_url')) if u]
+            created.extend(new_files)
+            if not user:
+                stale.extend(new_files)
+                continue
+            p = user[r['pid']]
+            if r['master']:
+                if p.get('foto') != r['url'] or p.get('foto_master') or (p['pos_x'], p['pos_y'], p['zoom']) != r['crop']:
+                    stale.extend(new_files)
+                    continue
+                p['foto_master'] = r['new_url']
+                delta = r['new_size']
+                if r['crop_url'] and uploaded_url_path(r['crop_url']) != uploaded_url_path(r['url']):
+                    p['foto'] = r['crop_url']
+                    delta += r['crop_size'] - r['old_size']
+                    stale.append(r['url'])
+                storage_account(user, r['pid'], delta, 1)
+                saved -= delta
+                files += 1
+            elif rewrite_client_media(user, lambda u, r=r: r['new_url'] if u == r['url'] else u):
+                storage_account(user, r['pid'], r['new_size'] - r['old_size'], 0)
+                stale.append(r['url'])
+                saved += r['old_size'] - r['new_size']
+                files += 1
+            else:
+                stale.append(r['new_url'])
+        checkpoint['done'][str(cid)] = {'saved': saved, 'files': files}
+        if files:
+            report.append((user.get('slug') or cid, files, saved))
+    if not save_db(clienti):
+        # I record puntano ancora agli originali: si eliminano solo i file appena creati.
+        for url in created:
+            delete_uploaded_url(url)
+        for cid in batch:
+            checkpoint['done'].pop(str(cid), None)
+        print("Errore DB: lotto non applicato, verrà ripreso al prossimo avvio.")
+        return None
+    # I file sostituiti si cancellano solo dopo che i record puntano ai nuovi.
+    for url in stale:
+        delete_uploaded_url(url)
+    save_reencode_checkpoint(checkpoint_path, checkpoint)
+    return report
+
+
+@app.cli.command('reencode-uploads')
+@click.option('--workers', type=int, default=0, help='Processi paralleli (default: tutti i core).')
+@click.option('--checkpoint', 'checkpoint_path', default=os.path.join(BASE_DIR, 'reencode_checkpoint.json'), show_default=True, help='File di avanzamento per riprendere il job.')
+@click.option('--restart', is_flag=True, help='Ignora il checkpoint e ricomincia da capo.')
+def reencode_uploads_command(workers, checkpoint_path, restart):
+    """Ricomprime le immagini caricate e genera i master foto mancanti."""
+    if Image is None:
+        click.echo("Pillow non disponibile: niente da fare.")
+        return
+    checkpoint = {'done': {}} if restart else load_reencode_checkpoint(checkpoint_path)
+    jobs, batch, remaining = [], {}, {}
+    for user in load_db():
+        if str(user['id']) in checkpoint['done']:
+            continue
+        user_jobs = reencode_jobs(user)
+        jobs.extend(user_jobs)
+        batch[user['id']] = []
+        remaining[user['id']] = len(user_jobs)
+    ready = {cid: [] for cid, n in remaining.items() if n == 0}
+    total_files = total_saved = failed = 0
+
+    def flush():
+        nonlocal total_files, total_saved, failed
+        report = apply_reencode_results(ready, checkpoint, checkpoint_path)
+        if report is None:
+            failed += 1
+        for slug, files, saved in report or []:
+            click.echo(f"{slug}: {files} file, {saved / 1024 / 1024:.2f} MB risparmiati")
+            total_files += files
+            total_saved += saved
+        ready.clear()
+
+    with ProcessPoolExecutor(max_workers=workers or None) as pool:
+        for fut in as_completed([pool.submit(reencode_image_file, job) for job in jobs]):
+            r = fut.result()
+            if r['error']:
+                click.echo(f"Errore {r['url']}: {r['error']}")
+            batch[r['client']].append(r)
+            remaining[r['client']] -= 1
+            if remaining[r['client']] == 0:
+                ready[r['client']] = batch.pop(r['client'])
+                if len(ready) >= REENCODE_BATCH:
+                    flush()
+    if ready:
+        flush()
+    # Il checkpoint serve solo a riprendere un job interrotto: a giro completo si azzera.
+    if not failed:
+        try:
+            os.remove(checkpoint_path)
+        except OSError:
+            pass
+    click.echo(f"Completato: {len(jobs)} immagini analizzate, {total_files} sostituite, {total_saved / 1024 / 1024:.2f} MB risparmiati.")
+
+
+def warm_templates(names=HOT_TEMPLATES) -> int:
+    compiled = 0
+    for name in names:
+        try:
+            app.jinja_env.get_template(name)
+            compiled += 1
+        except Exception as e:
+            print(f"Template {name} non compilato: {e}")
+    return compiled
+
+
+@app.cli.command('compile-templates')
+def compile_templates_command():
+    """Compila tutti i template nella cache bytecode condivisa."""
+    names = [n for n in app.jinja_env.list_templates() if n.endswith(('.html', '.js'))]
+    compiled = warm_templates(names)
+    click.echo(f"Template compilati: {compiled}/{len(names)} in {JINJA_CACHE_DIR}")
+
+
+# Ogni worker carica i template caldi all'import, prima di accettare richieste.
+warm_templates()
+
+
 if __name__ == '__main__':
     app.run(debug=True)
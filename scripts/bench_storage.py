@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# =========================
+# Pay4You - Benchmark del layer dati
+# - Dataset sintetici (1k / 10k / 100k clienti)
+# - Tempo (mediana, min, max) e picco di memoria per operazione
+# - Output JSON, confrontabile tra backend diversi
+#
+# Uso:
+#   python scripts/bench_storage.py
+#   python scripts/bench_storage.py --sizes 1000,10000 --repeat 7 --out bench.json
+#
+# Un nuovo motore di storage si confronta aggiungendo un adapter in BACKENDS
+# (load / save / cleanup) e lanciando con --backend <nome>.
+# =========================
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Senza /var/data app.py usa cwd/static: si importa da una cartella temporanea
+# per non toccare i dati del repo.
+CALLER_CWD = os.getcwd()
+WORKDIR = tempfile.mkdtemp(prefix='p4y-bench-')
+os.chdir(WORKDIR)
+
+import app  # noqa: E402
+
+
+# ---- Dataset ----
+def make_profile(rng, cid: int, pid: str, active: bool) -> dict:
+    if not active:
+        return {'active': False}
+    n_img = rng.randint(0, 10)
+    n_vid = rng.randint(0, 3)
+    n_pdf = rng.randint(0, 4)
+    return {
+        'active': True,
+        'name': f"Agente {cid} {pid}",
+        'role': rng.choice(['Consulente', 'Titolare', 'Agente', '']),
+        'company': f"Azienda {cid % 997}",
+        'bio': 'Lorem ipsum dolor sit amet. ' * rng.randint(0, 8),
+        'foto': f"/uploads/u{cid}/u{cid}_{pid}_foto_crop_{cid:010x}.jpg",
+        'foto_master': f"/uploads/u{cid}/u{cid}_{pid}_foto_master_{cid:010x}.jpg",
+        'logo': f"/uploads/u{cid}/u{cid}_{pid}_logo.png" if rng.random() < 0.6 else '',
+        'mobiles': [f"+39 3{rng.randint(10, 99)} {rng.randint(1000000, 9999999)}" for _ in range(rng.randint(1, 2))],
+        'emails': [f"c{cid}.{pid}@example.it"],
+        'websites': [f"https://c{cid}.example.it"] if rng.random() < 0.5 else [],
+        'socials': [{'label': 'Instagram', 'url': f"https://instagram.com/c{cid}"}] if rng.random() < 0.7 else [],
+        'gallery_img': [f"/uploads/u{cid}/u{cid}_{pid}_gimg_{i}.jpg" for i in range(n_img)],
+        'gallery_vid': [f"/uploads/u{cid}/u{cid}_{pid}_gvid_{i}.mp4" for i in range(n_vid)],
+        'gallery_pdf': [{'path': f"/uploads/u{cid}/u{cid}_{pid}_gpdf_{i}.pdf", 'name': f"Listino {i}"} for i in range(n_pdf)],
+        'pos_x': rng.randint(-20, 20),
+        'pos_y': rng.randint(-20, 20),
+        'zoom': round(rng.uniform(1.0, 2.0), 2),
+        'trans': {'en': {'role': 'Consultant', 'bio': 'Lorem ipsum.'}} if rng.random() < 0.3 else {},
+    }
+
+
+def make_clients(n: int, seed: int = 42) -> list:
+    rng = random.Random(seed)
+    out = []
+    for cid in range(1, n + 1):
+        out.append({
+            'id': cid,
+            'slug': f"card-{cid}",
+            'username': f"card-{cid}",
+            'password': f"pw{cid:08d}",
+            'must_change_password': rng.random() < 0.1,
+            'nome': f"Cliente {cid}",
+            'default_profile': 'p1',
+            'admin_contact': {'email': f"admin{cid}@example.it", 'whatsapp': f"+39333{cid:07d}"},
+            'p1': make_profile(rng, cid, 'p1', True),
+            'p2': make_profile(rng, cid, 'p2', rng.random() < 0.3),
+            'p3': make_profile(rng, cid, 'p3', rng.random() < 0.1),
+            'storage': {'bytes': rng.randint(0, 200) * 1024 * 1024, 'files': rng.randint(0, 40)},
+        })
+    return out
+
+
+# ---- Backend ----
+class JsonFileBackend:
+    # Il file clients.json di produzione, tramite load_db/save_db di app.py.
+    name = 'json'
+
+    def __init__(self, workdir: str):
+        self.path = os.path.join(workdir, 'clients.json')
+        app.DB_FILE = self.path
+
+    def seed(self, raw: list):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(raw, f, ensure_ascii=False, separators=(',', ':'))
+
+    def load(self) -> list:
+        return app.load_db()
+
+    def save(self, clienti: list):
+        app.save_db(clienti)
+
+    def size_bytes(self) -> int:
+        return os.path.getsize(self.path)
+
+    def cleanup(self):
+        pass
+
+
+BACKENDS = {
+    'json': JsonFileBackend,
+}
+
+
+# ---- Misure ----
+def measure(fn, repeat: int, setup=None) -> dict:
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        t0 = time.perf_counter()
+        fn(arg)
+        times.append(time.perf_counter() - t0)
+    arg = setup() if setup else None
+    tracemalloc.start()
+    fn(arg)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'median_ms': round(statistics.median(times) * 1000, 3),
+        'min_ms': round(min(times) * 1000, 3),
+        'max_ms': round(max(times) * 1000, 3),
+        'peak_kb': round(peak / 1024, 1),
+        'repeat': repeat,
+    }
+
+
+def bench_size(backend, n: int, repeat: int, seed: int) -> dict:
+    backend.seed(make_clients(n, seed))
+    clienti = backend.load()
+    last = clienti[-1]
+    mid = clienti[len(clienti) // 2]
+    ops = {}
+
+    ops['load_db'] = measure(lambda _: backend.load(), repeat)
+    ops['save_db'] = measure(lambda _: backend.save(clienti), repeat)
+
+    # repair_user: costo per record su dati appena caricati (nessun valore da correggere).
+    def repair_all(data):
+        for c in data:
+            app.repair_user(c)
+    r = measure(repair_all, repeat, setup=backend.load)
+    r['per_record_us'] = round(r['median_ms'] * 1000 / n, 3)
+    ops['repair_user'] = r
+
+    ops['get_user_by_id_mid'] = measure(lambda _: app.get_user_by_id(clienti, mid['id']), repeat)
+    ops['get_user_by_id_last'] = measure(lambda _: app.get_user_by_id(clienti, last['id']), repeat)
+    ops['get_user_by_id_miss'] = measure(lambda _: app.get_user_by_id(clienti, -1), repeat)
+    ops['get_user_by_email_last'] = measure(
+        lambda _: app.get_user_by_email(clienti, last['admin_contact']['email']), repeat)
+    ops['get_user_by_email_miss'] = measure(lambda _: app.get_user_by_email(clienti, 'nessuno@example.it'), repeat)
+    ops['slug_scan_last'] = measure(
+        lambda _: next((c for c in clienti if c.get('slug') == last['slug']), None), repeat)
+    ops['slug_scan_miss'] = measure(
+        lambda _: next((c for c in clienti if c.get('slug') == 'wp-login.php'), None), repeat)
+    # Percorso reale delle route card: indice in memoria + lettura completa solo se lo slug esiste.
+    ops['slug_exists_hit'] = measure(lambda _: app.slug_exists(last['slug']), repeat)
+    ops['slug_exists_miss'] = measure(lambda _: app.slug_exists('wp-login.php'), repeat)
+    ops['card_lookup_hit'] = measure(
+        lambda _: app.slug_exists(last['slug']) and next(
+            (c for c in backend.load() if c.get('slug') == last['slug']), None), repeat)
+
+    return {'clients': n, 'file_bytes': backend.size_bytes(), 'ops': ops}
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description='Benchmark del layer dati Pay4You')
+    ap.add_argument('--backend', default='json', choices=sorted(BACKENDS))
+    ap.add_argument('--sizes', default='1000,10000,100000', help='numero di clienti, separati da virgola')
+    ap.add_argument('--repeat', type=int, default=5)
+    ap.add_argument('--seed', type=int, default=42)
+    ap.add_argument('--out', default='', help='file JSON di output (default: stdout)')
+    args = ap.parse_args(argv)
+
+    sizes = [int(x) for x in args.sizes.split(',') if x.strip()]
+    backend = BACKENDS[args.backend](WORKDIR)
+    results = []
+    try:
+        for n in sizes:
+            print(f"[bench] {backend.name} {n} clienti...", file=sys.stderr)
+            results.append(bench_size(backend, n, max(1, args.repeat), args.seed))
+    finally:
+        backend.cleanup()
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+
+    report = {
+        'backend': backend.name,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': int(time.time()),
+        'seed': args.seed,
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        # Percorsi relativi alla cartella da cui è stato lanciato lo script, non a WORKDIR.
+        with open(os.path.join(CALLER_CWD, args.out), 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
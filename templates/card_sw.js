@@ -0,0 +1,92 @@
+// Pay4You - service worker della card {{ slug }}
+const CACHE_PREFIX = {{ ('p4y-card-' ~ slug ~ '-')|tojson }};
+const CACHE_NAME = CACHE_PREFIX + {{ version|tojson }};
+const SCOPE = {{ scope|tojson }};
+const PRECACHE = {{ assets|tojson }};
+const REVALIDATE_MS = {{ revalidate_ms }};
+const CDN_HOSTS = {{ cdn_hosts|tojson }};
+const STAMP = "x-p4y-cached-at";
+
+function stamp(resp) {
+  if (resp.type === "opaque") return resp;
+  const headers = new Headers(resp.headers);
+  headers.set(STAMP, String(Date.now()));
+  return new Response(resp.body, { status: resp.status, statusText: resp.statusText, headers: headers });
+}
+
+function isStale(resp) {
+  if (resp.type === "opaque") return false;
+  const at = parseInt(resp.headers.get(STAMP) || "0", 10);
+  return (Date.now() - at) > REVALIDATE_MS;
+}
+
+function ownPath(p) {
+  return p === SCOPE || p.startsWith(SCOPE + "/");
+}
+
+function inScope(url) {
+  // Fuori origine solo i CDN noti (URL versionati): il resto non finisce in cache.
+  if (url.origin !== self.location.origin) return CDN_HOSTS.includes(url.hostname);
+  const p = url.pathname;
+  return ownPath(p) || p.startsWith("/static/") || p.startsWith("/uploads/") || p === "/vcf/" + SCOPE.split("/").pop();
+}
+
+// Lo scope "/card/slug" copre anche "/card/slugaltro": si servono solo le pagine di questa card.
+async function fromOwnCard(event) {
+  if (!event.clientId) return false;
+  const client = await self.clients.get(event.clientId);
+  return !!client && ownPath(new URL(client.url).pathname);
+}
+
+self.addEventListener("install", (event) => {
+  event.waitUntil(
+    caches.open(CACHE_NAME).then((cache) => Promise.all(PRECACHE.map((url) =>
+      fetch(url, { credentials: "same-origin" })
+        .then((resp) => resp.ok ? cache.put(url, stamp(resp)) : null)
+        .catch(() => null)
+    ))).then(() => self.skipWaiting())
+  );
+});
+
+self.addEventListener("activate", (event) => {
+  event.waitUntil(
+    caches.keys()
+      .then((keys) => Promise.all(keys.filter((k) => k.startsWith(CACHE_PREFIX) && k !== CACHE_NAME).map((k) => caches.delete(k))))
+      .then(() => self.clients.claim())
+  );
+});
+
+async function staleWhileRevalidate(event) {
+  const req = event.request;
+  const cache = await caches.open(CACHE_NAME);
+  const cached = await cache.match(req);
+  const refresh = () => fetch(req).then((resp) => {
+    if (resp.ok || resp.type === "opaque") cache.put(req, stamp(resp.clone()));
+    return resp;
+  });
+  if (cached) {
+    if (isStale(cached)) event.waitUntil(refresh().catch(() => null));
+    return cached;
+  }
+  try {
+    return await refresh();
+  } catch (err) {
+    if (req.mode === "navigate") {
+      const fallback = await cache.match(SCOPE);
+      if (fallback) return fallback;
+    }
+    throw err;
+  }
+}
+
+self.addEventListener("fetch", (event) => {
+  const req = event.request;
+  if (req.method !== "GET" || req.headers.has("range")) return;
+  const url = new URL(req.url);
+  if (req.mode === "navigate") {
+    if (ownPath(url.pathname)) event.respondWith(staleWhileRevalidate(event));
+    return;
+  }
+  if (!inScope(url)) return;
+  event.respondWith(fromOwnCard(event).then((own) => own ? staleWhileRevalidate(event) : fetch(req)));
+});